@@ -14,12 +14,18 @@ class Adagrad(Optimizer):
         lr (float, optional): learning rate (default: 1e-2)
         lr_decay (float, optional): learning rate decay (default: 0)
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        sketch_dtype (torch.dtype, optional): storage type of the count-min
+            sketch used for sparse parameters, torch.float32 or torch.bfloat16.
+            The sketch sums g^2 without decay, so bfloat16 slots are stochastically
+            rounded to keep growing in expectation; each slot is noisier than in
+            float32 (default: torch.float32)
 
     .. _Adaptive Subgradient Methods for Online Learning and Stochastic
         Optimization: http://jmlr.org/papers/v12/duchi11a.html
     """
 
-    def __init__(self, params, lr=1e-2, lr_decay=0, weight_decay=0, initial_accumulator_value=0):
+    def __init__(self, params, lr=1e-2, lr_decay=0, weight_decay=0, initial_accumulator_value=0,
+                 sketch_dtype=torch.float32):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= lr_decay:
@@ -28,11 +34,19 @@ class Adagrad(Optimizer):
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
         if not 0.0 <= initial_accumulator_value:
             raise ValueError("Invalid initial_accumulator_value value: {}".format(initial_accumulator_value))
+        if sketch_dtype not in (torch.float32, torch.bfloat16):
+            raise ValueError("Invalid sketch_dtype value: {}".format(sketch_dtype))
 
         defaults = dict(lr=lr, lr_decay=lr_decay, weight_decay=weight_decay,
-                        initial_accumulator_value=initial_accumulator_value)
+                        initial_accumulator_value=initial_accumulator_value,
+                        sketch_dtype=sketch_dtype)
         super(Adagrad, self).__init__(params, defaults)
 
+    def __setstate__(self, state):
+        super(Adagrad, self).__setstate__(state)
+        for group in self.param_groups:
+            group.setdefault('sketch_dtype', torch.float32)
+
     def step(self, closure=None):
         """Performs a single optimization step.
 
@@ -56,7 +70,7 @@ class Adagrad(Optimizer):
                     state['step'] = 0
                     if grad.is_sparse:
                         N, D = grad.data.size()
-                        state['sum'] = CountMinSketch(N, D)
+                        state['sum'] = CountMinSketch(N, D, dtype=group['sketch_dtype'])
                     else:
                         state['sum'] = torch.full_like(grad.data, group['initial_accumulator_value'])
 
@@ -70,20 +84,16 @@ class Adagrad(Optimizer):
 
                 if grad.is_sparse:
                     grad = grad.coalesce()  # the update is non-linear so indices must be unique
+                    if grad.sparse_dim() != 1:
+                        raise ValueError("Sparse gradients must be row-sparse (nnz, D), got sparse_dim {}".format(grad.sparse_dim()))
                     grad_indices = grad._indices()
                     grad_values = grad._values()
                     size = grad.size()
 
-                    def make_sparse(values):
-                        constructor = grad.new
-                        if grad_indices.dim() == 0 or values.dim() == 0:
-                            return constructor().resize_as_(grad)
-                        return constructor(grad_indices, values, size)
-
                     std = state['sum'].update(grad_indices, grad_values.pow(2), size)
                     std_values = std._values().sqrt_().add_(1e-10)
                     update = grad_values / std_values
-                    p.data.add_(make_sparse(-clr * update))
+                    p.data.index_add_(0, grad_indices[0], -clr * update)
                 else:
                     state['sum'].addcmul_(1, grad, grad)
                     std = state['sum'].sqrt().add_(1e-10)
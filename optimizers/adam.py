@@ -4,6 +4,7 @@ from torch.optim import Optimizer
 
 from exp_cms import CountMinSketch
 from exp_sketch import CountSketch 
+from sparse_update import sparse_normalized_update
 
 class Adam(Optimizer):
     """Implements Adam algorithm.
@@ -21,6 +22,18 @@ class Adam(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
+        coalesced_grads (boolean, optional): whether sparse gradients are
+            known to have unique indices, so coalescing can be skipped
+            (default: False)
+        cuda_graph (boolean, optional): whether to capture the dense parameter
+            updates into a CUDA graph after a few warmup steps and replay it
+            on later steps. Dense gradients must stay in the same tensors
+            between steps (e.g. ``zero_grad(set_to_none=False)``) and only
+            ``lr`` may be changed after capture (default: False)
+
+    The bias correction is computed once per parameter group from a group-level
+    step counter, which advances on every call to ``step`` even for
+    parameters whose gradient is ``None`` in that step.
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -29,7 +42,8 @@ class Adam(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, coalesced_grads=False,
+                 cuda_graph=False):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -39,22 +53,51 @@ class Adam(Optimizer):
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad,
+                        coalesced_grads=coalesced_grads, cuda_graph=cuda_graph)
         super(Adam, self).__init__(params, defaults)
+        self._graph = None
+        self._graph_key = None
+        self._graph_warmup = 0
+        self._graph_step_sizes = dict()
 
     def __setstate__(self, state):
         super(Adam, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('coalesced_grads', False)
+            group.setdefault('cuda_graph', False)
+        for param_state in self.state.values():
+            if 'step' in param_state and not torch.is_tensor(param_state['step']):
+                param_state['step'] = torch.tensor(param_state['step'])
+        for group in self.param_groups:
+            # Older checkpoints only track steps per parameter
+            if 'step' not in group:
+                steps = [int(self.state[p]['step']) for p in group['params']
+                         if p in self.state and 'step' in self.state[p]]
+                if steps:
+                    beta1, beta2 = group['betas']
+                    group['step'] = max(steps)
+                    group['beta1_pow'] = beta1 ** group['step']
+                    group['beta2_pow'] = beta2 ** group['step']
+        # A captured graph refers to the replaced state tensors, so recapture
+        self._graph = None
+        self._graph_key = None
+        self._graph_warmup = 0
+        self._graph_step_sizes = dict()
+
+    def dense(self, p, grad, group, step_size):
+        self.dense_state(p, group)
+        self.dense_update(p, grad, group, step_size)
 
-    def dense(self, p, grad, group):
+    def dense_state(self, p, group):
         amsgrad = group['amsgrad']
         state = self.state[p]
         beta1, beta2 = group['betas']
 
         # State initialization
         if len(state) == 0:
-            state['step'] = 0
+            state['step'] = torch.tensor(0)
             if beta1 > 0:
                 # Exponential moving average of gradient values
                 state['exp_avg'] = torch.zeros_like(p.data)
@@ -64,7 +107,13 @@ class Adam(Optimizer):
                 # Maintains max of all exp. moving avg. of sq. grad. values
                 state['max_exp_avg_sq'] = torch.zeros_like(p.data)
 
-        state['step'] += 1
+        state['step'].add_(1)
+
+    def dense_update(self, p, grad, group, step_size):
+        amsgrad = group['amsgrad']
+        state = self.state[p]
+        beta1, beta2 = group['betas']
+
         if group['weight_decay'] != 0:
            grad = grad.add(group['weight_decay'], p.data)
 
@@ -87,44 +136,79 @@ class Adam(Optimizer):
         else:
             denom = exp_avg_sq.sqrt().add_(group['eps'])
 
-        bias_correction1 = 1 - beta1 ** state['step']
-        bias_correction2 = 1 - beta2 ** state['step']
-        step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+        numer = exp_avg if beta1 > 0 else grad
+        if torch.is_tensor(step_size):
+            # Device-resident step size, so a captured CUDA graph sees each new value
+            p.data.addcmul_(step_size, numer.div(denom), value=-1)
+        else:
+            p.data.addcdiv_(-step_size, numer, denom)
 
-        if beta1 > 0:
-            p.data.addcdiv_(-step_size, exp_avg, denom)
+    def graph_dense(self, dense_params):
+        """Applies the dense updates by replaying a captured CUDA graph.
+
+        The graph is (re)captured after a few warmup steps whenever the set of
+        dense parameters, their gradient tensors or their state tensors change.
+        """
+        for p, group, _ in dense_params:
+            self.dense_state(p, group)
+
+        key = tuple((id(p), p.grad.data_ptr()) +
+                    tuple(value.data_ptr() for value in self.state[p].values()
+                          if torch.is_tensor(value) and value.is_cuda)
+                    for p, _, _ in dense_params)
+        if key != self._graph_key:
+            self._graph = None
+            self._graph_key = key
+            self._graph_warmup = 0
+
+        if self._graph is not None:
+            self._graph.replay()
+            return
+
+        def update():
+            for p, group, step_size in dense_params:
+                self.dense_update(p, p.grad.data, group, step_size)
+
+        self._graph_warmup += 1
+        if self._graph_warmup <= 3:
+            # Warm up on a side stream before capture, as torch.cuda.graph requires
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                update()
+            torch.cuda.current_stream().wait_stream(stream)
         else:
-            p.data.addcdiv_(-step_size, grad, denom)
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                update()
+            # Capture only records the kernels, so replay to apply this step
+            self._graph.replay()
 
-    def sparse(self, p, grad, group):
+    def sparse(self, p, grad, group, step_size):
         state = self.state[p]
         beta1, beta2 = group['betas']
 
         # State initialization
         if len(state) == 0:
             N, D = grad.data.size()
-            state['step'] = 0
+            state['step'] = torch.tensor(0)
             if beta1 > 0:
                 # Exponential moving average of gradient values
                 state['exp_avg'] = CountSketch(N, D)
             # Exponential moving average of squared gradient values
             state['exp_avg_sq'] = CountMinSketch(N, D)
 
-        state['step'] += 1
+        state['step'].add_(1)
         if group['weight_decay'] != 0:
            grad = grad.add(group['weight_decay'], p.data)
 
-        grad = grad.coalesce()  # the update is non-linear so indices must be unique
+        # the update is non-linear so indices must be unique
+        if not group['coalesced_grads'] and not grad.is_coalesced():
+            grad = grad.coalesce()
         grad_indices = grad._indices()
         grad_values = grad._values()
         size = grad.size()
 
-        def make_sparse(values):
-            constructor = grad.new
-            if grad_indices.dim() == 0 or values.dim() == 0:
-                return constructor().resize_as_(grad)
-            return constructor(grad_indices, values, size)
-
         if beta1 > 0:
             exp_avg = state['exp_avg']
             numer = exp_avg.update(grad_indices, grad_values, size, beta1)._values()
@@ -138,15 +222,10 @@ class Adam(Optimizer):
 
         # Decay the first and second moment running average coefficient
         #      old <- b * old + (1 - b) * new  <==> old += (1 - b) * (new - old)
-        exp_avg_sq_update = exp_avg_sq.update(grad_indices, grad_values.pow(2), size, beta2)._values()
-        denom = exp_avg_sq_update.sqrt_().add_(group['eps'])
-        update = numer / denom
+        exp_avg_sq_update = exp_avg_sq.update(grad_indices, grad_values, size, beta2, square=True)._values()
 
-        bias_correction1 = 1 - beta1 ** state['step']
-        bias_correction2 = 1 - beta2 ** state['step']
-        step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
-
-        p.data.add_(make_sparse(-step_size * update))
+        # p <- p - step_size * numer / (sqrt(exp_avg_sq) + eps) in a single kernel
+        sparse_normalized_update(p.data, grad_indices, numer, exp_avg_sq_update, step_size, group['eps'])
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -159,14 +238,39 @@ class Adam(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        dense_params = []
+        for index, group in enumerate(self.param_groups):
+            # Bias correction is shared by every parameter in the group
+            beta1, beta2 = group['betas']
+            if 'step' not in group:
+                group['step'] = 0
+                group['beta1_pow'] = 1.0
+                group['beta2_pow'] = 1.0
+            # Track beta ** step incrementally
+            group['step'] += 1
+            group['beta1_pow'] *= beta1
+            group['beta2_pow'] *= beta2
+            bias_correction1 = 1 - group['beta1_pow']
+            bias_correction2 = 1 - group['beta2_pow']
+            step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+
             for p in group['params']:
                 if p.grad is None:
                     continue
                 grad = p.grad.data
 
                 if grad.is_sparse:
-                    self.sparse(p, grad, group)
+                    self.sparse(p, grad, group, step_size)
+                elif group['cuda_graph']:
+                    if index not in self._graph_step_sizes:
+                        self._graph_step_sizes[index] = torch.zeros((), device=grad.device)
+                    dense_params.append((p, group, self._graph_step_sizes[index]))
                 else:
-                    self.dense(p, grad, group)
+                    self.dense(p, grad, group, step_size)
+
+            if index in self._graph_step_sizes:
+                self._graph_step_sizes[index].fill_(step_size)
+
+        if dense_params:
+            self.graph_dense(dense_params)
         return loss
@@ -2,6 +2,7 @@ import math
 import torch
 from torch.optim import Optimizer
 
+from sparse_adam import _sparse_adam_update
 
 class Adam(Optimizer):
     """Implements Adam algorithm.
@@ -101,6 +102,8 @@ class Adam(Optimizer):
         state['step'] += 1
 
         grad = grad.coalesce()  # the update is non-linear so indices must be unique
+        if grad.sparse_dim() != 1:
+            raise ValueError("Sparse gradients must be row-sparse (nnz, D), got sparse_dim {}".format(grad.sparse_dim()))
         grad_indices = grad._indices()
         grad_values = grad._values()
         size = grad.size()
@@ -108,33 +111,19 @@ class Adam(Optimizer):
         exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
         beta1, beta2 = group['betas']
 
-        def make_sparse(values):
-            constructor = grad.new
-            if grad_indices.dim() == 0 or values.dim() == 0:
-                return constructor().resize_as_(grad)
-            return constructor(grad_indices, values, size)
-
-        # Decay the first and second moment running average coefficient
-        #      old <- b * old + (1 - b) * new  <==> old += (1 - b) * (new - old)
-        old_exp_avg_values = exp_avg.sparse_mask(grad)._values()
-        exp_avg_update_values = grad_values.sub(old_exp_avg_values).mul_(1 - beta1)
-        exp_avg.add_(make_sparse(exp_avg_update_values))
-
-        old_exp_avg_sq_values = exp_avg_sq.sparse_mask(grad)._values()
-        exp_avg_sq_update_values = grad_values.pow(2).sub_(old_exp_avg_sq_values).mul_(1 - beta2)
-        exp_avg_sq.add_(make_sparse(exp_avg_sq_update_values))
-
-        # Dense addition again is intended, avoiding another sparse_mask
-        numer = exp_avg_update_values.add_(old_exp_avg_values)
-        exp_avg_sq_update_values.add_(old_exp_avg_sq_values)
-        denom = exp_avg_sq_update_values.sqrt_().add_(group['eps'])
-        del exp_avg_update_values, exp_avg_sq_update_values
-
         bias_correction1 = 1 - beta1 ** state['step']
         bias_correction2 = 1 - beta2 ** state['step']
         step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
 
-        p.data.add_(make_sparse(-step_size * numer.div_(denom)))
+        # Fused moment and parameter update
+        exp_avg_values, exp_avg_sq_values, update = _sparse_adam_update(
+                grad_values,
+                exp_avg.sparse_mask(grad)._values(),
+                exp_avg_sq.sparse_mask(grad)._values(),
+                beta1, beta2, group['eps'], step_size)
+        exp_avg.index_copy_(0, grad_indices[0], exp_avg_values)
+        exp_avg_sq.index_copy_(0, grad_indices[0], exp_avg_sq_values)
+        p.data.index_add_(0, grad_indices[0], update)
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -4,6 +4,7 @@ from torch.optim import Optimizer
 
 from exp_cms import CountMinSketch
 from exp_sketch import CountSketch 
+from sparse_adam import _sparse_adam_moments
 
 class Adam(Optimizer):
     """Implements Adam algorithm.
@@ -21,6 +22,9 @@ class Adam(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
+        debug_error (boolean, optional): whether to track the exact moments of
+            sparse parameters and report the sketch approximation error
+            (default: True)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -29,7 +33,7 @@ class Adam(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, debug_error=True):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -41,8 +45,12 @@ class Adam(Optimizer):
         defaults = dict(lr=lr, betas=betas, eps=eps,
                         weight_decay=weight_decay, amsgrad=amsgrad)
         super(Adam, self).__init__(params, defaults)
-        self.exp_avg_error = 0
-        self.exp_avg_sq_error = 0
+        self.debug_error = debug_error
+        # Device-resident [exp_avg, exp_avg_sq] error accumulator, allocated lazily
+        self.error = None
+        # Side stream for the baseline bookkeeping, created on first use since
+        # debug_error may be switched on after construction
+        self.error_stream = None
         self.count = 1
 
     def __setstate__(self, state):
@@ -100,27 +108,20 @@ class Adam(Optimizer):
             state['step'] = 0
             # Exponential moving average of gradient values
             state['exp_avg'] = CountSketch(N, D)
-            state['exp_avg_base'] = torch.zeros_like(p.data)
             # Exponential moving average of squared gradient values
             state['exp_avg_sq'] = CountMinSketch(N, D)
-            # Exponential moving average of squared gradient values
-            state['exp_avg_sq_base'] = torch.zeros_like(p.data)
 
         state['step'] += 1
         if group['weight_decay'] != 0:
            grad = grad.add(group['weight_decay'], p.data)
 
         grad = grad.coalesce()  # the update is non-linear so indices must be unique
+        if grad.sparse_dim() != 1:
+            raise ValueError("Sparse gradients must be row-sparse (nnz, D), got sparse_dim {}".format(grad.sparse_dim()))
         grad_indices = grad._indices()
         grad_values = grad._values()
         size = grad.size()
 
-        def make_sparse(values):
-            constructor = grad.new
-            if grad_indices.dim() == 0 or values.dim() == 0:
-                return constructor().resize_as_(grad)
-            return constructor(grad_indices, values, size)
-
         exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
         beta1, beta2 = group['betas']
 
@@ -130,54 +131,52 @@ class Adam(Optimizer):
 
         # Decay the first and second moment running average coefficient
         #      old <- b * old + (1 - b) * new  <==> old += (1 - b) * (new - old)
-
-        # Update Tensors for Gradient Update
-        #old_exp_avg_values = exp_avg.sparse_mask(grad)._values()
-        #exp_avg_update_values = grad_values.sub(old_exp_avg_values).mul_(1 - beta1)
-        #exp_avg.add_(make_sparse(exp_avg_update_values))
-        #numer = exp_avg_update_values.add_(old_exp_avg_values)
-        #del exp_avg_update_values
-
-        #old_exp_avg_sq_values = exp_avg_sq.sparse_mask(grad)._values()
-        #exp_avg_sq_update_values = grad_values.pow(2).sub_(old_exp_avg_sq_values).mul_(1 - beta2)
-        #exp_avg_sq.add_(make_sparse(exp_avg_sq_update_values))
-        #exp_avg_sq_update_values.add_(old_exp_avg_sq_values)
-        #denom = exp_avg_sq_update_values.sqrt_().add_(group['eps'])
-        #del exp_avg_sq_update_values
-
         numer = exp_avg.update(grad_indices, grad_values, size, beta1)._values()
-        exp_avg_sq_update = exp_avg_sq.update(grad_indices, grad_values.pow(2), size, beta2)._values()
+        exp_avg_sq_update = exp_avg_sq.update(grad_indices, grad_values, size, beta2, square=True)._values()
         denom = exp_avg_sq_update.sqrt_().add_(group['eps'])
         update = numer / denom
 
-        # Update Baseline Tensors for Error Comparison
-        exp_avg_base = state['exp_avg_base']
-        old_exp_avg_values_base = exp_avg_base.sparse_mask(grad)._values()
-        exp_avg_update_values_base = grad_values.sub(old_exp_avg_values_base).mul_(1 - beta1)
-        exp_avg_base.add_(make_sparse(exp_avg_update_values_base))
-        exp_avg_values_base = exp_avg_update_values_base.add_(old_exp_avg_values_base)
-
-        exp_avg_sq_base = state['exp_avg_sq_base']
-        old_exp_avg_sq_values_base = exp_avg_sq_base.sparse_mask(grad)._values()
-        exp_avg_sq_update_values_base = grad_values.pow(2).sub_(old_exp_avg_sq_values_base).mul_(1 - beta2)
-        exp_avg_sq_base.add_(make_sparse(exp_avg_sq_update_values_base))
-        exp_avg_sq_values_base = exp_avg_sq_base.sparse_mask(grad)._values()
-
-        if self.count % 125 == 0:
-            print(self.exp_avg_error/self.count)
-            print(self.exp_avg_sq_error/self.count)
-            self.exp_avg_error = 0
-            self.exp_avg_sq_error = 0
-            self.count = 1
-        self.exp_avg_error += torch.sum(torch.abs(numer - exp_avg_values_base)).item()
-        self.exp_avg_sq_error += torch.sum(torch.abs(denom - exp_avg_sq_values_base)).item()
-        self.count += 1
-
         bias_correction1 = 1 - beta1 ** state['step']
         bias_correction2 = 1 - beta2 ** state['step']
         step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
 
-        p.data.add_(make_sparse(-step_size * update))
+        if self.debug_error:
+            if self.error_stream is None:
+                self.error_stream = torch.cuda.Stream()
+            if 'exp_avg_base' not in state:
+                # Exact moments of the sketched moving averages, tracked from the
+                # step debug_error is enabled on
+                state['exp_avg_base'] = torch.zeros_like(p.data)
+                state['exp_avg_sq_base'] = torch.zeros_like(p.data)
+            # Wait for numer and denom, then overlap the baseline with the update below
+            self.error_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.error_stream):
+                # Update Baseline Tensors for Error Comparison
+                exp_avg_base, exp_avg_sq_base = state['exp_avg_base'], state['exp_avg_sq_base']
+                exp_avg_values_base, exp_avg_sq_values_base = _sparse_adam_moments(
+                        grad_values,
+                        exp_avg_base.sparse_mask(grad)._values(),
+                        exp_avg_sq_base.sparse_mask(grad)._values(),
+                        beta1, beta2)
+                exp_avg_base.index_copy_(0, grad_indices[0], exp_avg_values_base)
+                exp_avg_sq_base.index_copy_(0, grad_indices[0], exp_avg_sq_values_base)
+
+                if self.error is None:
+                    self.error = torch.zeros(2, device=grad_values.device)
+                if self.count % 125 == 0:
+                    exp_avg_error, exp_avg_sq_error = (self.error / self.count).tolist()
+                    print(exp_avg_error)
+                    print(exp_avg_sq_error)
+                    self.error.zero_()
+                    self.count = 1
+                error = torch.stack((numer - exp_avg_values_base, denom - exp_avg_sq_values_base))
+                self.error.add_(error.abs_().sum(dim=(1, 2)))
+                self.count += 1
+            # Keep the allocator from reusing these while the side stream reads them
+            for tensor in (grad_indices, grad_values, numer, denom):
+                tensor.record_stream(self.error_stream)
+
+        p.data.index_add_(0, grad_indices[0], -step_size * update)
 
     def step(self, closure=None):
         """Performs a single optimization step.
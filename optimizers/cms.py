@@ -3,10 +3,83 @@ from cupy_kernel import cupyKernel
 import numpy as np
 import math
 
+# Sketch storage type - the kernels always accumulate in float32 registers
+storage = {
+    torch.float32: '''
+typedef float sketch_t;
+typedef float4 sketch4_t;
+
+extern "C"
+__inline__ __device__
+float load(const sketch_t x)
+{
+	return x;
+}
+
+extern "C"
+__inline__ __device__
+sketch_t store(const float x, const unsigned int bits)
+{
+	return x;
+}
+
+extern "C"
+__inline__ __device__
+float4 load4(const sketch4_t x)
+{
+	return x;
+}
+
+extern "C"
+__inline__ __device__
+sketch4_t store4(const float4 x, const uint2 bits)
+{
+	return x;
+}
+    ''',
+    torch.bfloat16: '''
+// bfloat16 is the upper half of a float32
+typedef unsigned short sketch_t;
+typedef ushort4 sketch4_t;
+
+extern "C"
+__inline__ __device__
+float load(const sketch_t x)
+{
+	return __uint_as_float(((unsigned int) x) << 16);
+}
+
+extern "C"
+__inline__ __device__
+sketch_t store(const float x, const unsigned int bits)
+{
+	// Stochastic rounding with the low 16 random bits: the sketch sums g^2 without
+	// decay, so round to nearest would drop every increment below half an ulp
+	const unsigned int u = __float_as_uint(x);
+	return (sketch_t) ((u + (bits & 0xffff)) >> 16);
+}
+
+extern "C"
+__inline__ __device__
+float4 load4(const sketch4_t x)
+{
+	return make_float4(load(x.x), load(x.y), load(x.z), load(x.w));
+}
+
+extern "C"
+__inline__ __device__
+sketch4_t store4(const float4 x, const uint2 bits)
+{
+	return make_ushort4(store(x.x, bits.x), store(x.y, bits.x >> 16),
+		store(x.z, bits.y), store(x.w, bits.y >> 16));
+}
+    ''',
+}
+
 kernel = '''
 extern "C"
 __inline__ __device__
-int hash(int value, int range, int a, int b)
+int hash(int value, int mask, int a, int b)
 {
 	int h = a * value + b;
 	h ^= h >> 16;
@@ -14,9 +87,13 @@ int hash(int value, int range, int a, int b)
 	h ^= h >> 13;
 	h *= 0xc2b2ae35;
 	h ^= h >> 16;
-	return h % range;
+	return h & mask;
 }
 
+// Hash coefficients for the three sketch rows
+__constant__ int hash_a[3] = {994443, 4113759, 9171025};
+__constant__ int hash_b[3] = {609478, 2949676, 2171464};
+
 extern "C"
 __inline__ __device__
 float minimum(float a, float b, float c)
@@ -26,72 +103,140 @@ float minimum(float a, float b, float c)
 
 extern "C"
 __inline__ __device__
-float update_retrieve(float* mem,
+float update_retrieve(sketch_t* mem,
 	float* result,
-	const int N,
+	const int mask,
 	const int D,
 	const long index,
 	const float value)
 {
     	int a = 994443;
     	int b = 609478;
-        const int hash_idx = hash(index, N, a, b) * D + threadIdx.x;
-		mem[hash_idx] += value; 
-        return mem[hash_idx];
+        const int hash_idx = hash(index, mask, a, b) * D + threadIdx.x;
+		const float m = load(mem[hash_idx]) + value;
+		mem[hash_idx] = store(m, hash(hash_idx, -1, a, b));
+        return m;
 }
 
 extern "C"
 __inline__ __device__
-float cms_update_retrieve(float* mem,
+float cms_update_retrieve(sketch_t* mem,
 	float* result,
-	const int N,
+	const int mask,
 	const int W,
 	const int D,
 	const long index,
-	const float value)
+	const float value,
+	const int seed)
 {
 	float r[3];
-	int a[3] = {994443, 4113759, 9171025};
-	int b[3] = {609478, 2949676, 2171464};
+	int hash_idx[3];
+	// The rows never alias, so issue all three loads before any store
+	for(int idx = 0; idx < 3; ++idx)
+	{
+		hash_idx[idx] = idx*W + hash(index, mask, hash_a[idx], hash_b[idx]) * D + threadIdx.x;
+		r[idx] = load(mem[hash_idx[idx]]) + value;
+	}
 	for(int idx = 0; idx < 3; ++idx)
 	{
-		const int hash_idx = idx*W + hash(index, N, a[idx], b[idx]) * D + threadIdx.x;
-		mem[hash_idx] += value; 
-		r[idx] = mem[hash_idx];
+		mem[hash_idx[idx]] = store(r[idx], hash(hash_idx[idx], -1, hash_a[idx], seed));
 	}
 	return minimum(r[0], r[1], r[2]);
 }
 
+extern "C"
+__inline__ __device__
+float4 cms_update_retrieve4(sketch_t* mem,
+	const int mask,
+	const int W,
+	const int D,
+	const long index,
+	const float4 value,
+	const int seed)
+{
+	float4 r[3];
+	int hash_idx[3];
+	// The rows never alias, so issue all three loads before any store
+	for(int idx = 0; idx < 3; ++idx)
+	{
+		// The hash only depends on the index, so 4 consecutive lanes share one slot
+		hash_idx[idx] = idx*W + hash(index, mask, hash_a[idx], hash_b[idx]) * D + 4 * threadIdx.x;
+		float4 m = load4(*reinterpret_cast<sketch4_t*>(&mem[hash_idx[idx]]));
+		m.x += value.x;
+		m.y += value.y;
+		m.z += value.z;
+		m.w += value.w;
+		r[idx] = m;
+	}
+	for(int idx = 0; idx < 3; ++idx)
+	{
+		const uint2 bits = make_uint2(hash(hash_idx[idx], -1, hash_a[idx], seed),
+			hash(hash_idx[idx], -1, hash_b[idx], seed));
+		*reinterpret_cast<sketch4_t*>(&mem[hash_idx[idx]]) = store4(r[idx], bits);
+	}
+	return make_float4(minimum(r[0].x, r[1].x, r[2].x),
+		minimum(r[0].y, r[1].y, r[2].y),
+		minimum(r[0].z, r[1].z, r[2].z),
+		minimum(r[0].w, r[1].w, r[2].w));
+}
+
 extern "C"
 __global__
 void hash_update_retrieve(const long* indices,
 	const float* values,
-	float* mem,
+	sketch_t* mem,
 	float* result,
-	const int N,
+	const int mask,
 	const int W,
-    const int D)
+    const int D,
+	const int seed)
 {
 	if(threadIdx.x < D)
 	{
 		const int idx = blockIdx.x * D + threadIdx.x;
 		const float value = values[idx];
 		const long index = indices[blockIdx.x];
-		result[idx] = cms_update_retrieve(mem, result, N, W, D, index, value);
+		result[idx] = cms_update_retrieve(mem, result, mask, W, D, index, value, seed);
+	}
+}
+
+extern "C"
+__global__
+void hash_update_retrieve_vec4(const long* indices,
+	const float4* values,
+	sketch_t* mem,
+	float4* result,
+	const int mask,
+	const int W,
+	const int D,
+	const int seed)
+{
+	const int D4 = D / 4;
+	if(threadIdx.x < D4)
+	{
+		const int idx = blockIdx.x * D4 + threadIdx.x;
+		const float4 value = values[idx];
+		const long index = indices[blockIdx.x];
+		result[idx] = cms_update_retrieve4(mem, mask, W, D, index, value, seed);
 	}
 }
 '''
 
 class CountMinSketch:
-    def __init__(self, N, D, sketch_size=0.20):
+    def __init__(self, N, D, sketch_size=0.20, dtype=torch.float32):
+        if dtype not in storage:
+            raise ValueError("Invalid sketch dtype: {}".format(dtype))
         self.N = N
         self.D = D
-        self.blk_size = math.ceil(D // 32) * 32
-        self.range = int(N*sketch_size/3.)
+        self.dtype = dtype
+        self.blk_size = int(math.ceil(D / 32.)) * 32
+        self.range = 1 << (max(int(N*sketch_size/3.), 1).bit_length() - 1)
         self.width = self.range * D
         device = torch.cuda.current_device()
-        self.cms = torch.FloatTensor(3, self.range, D).fill_(0).to(device)
+        self.cms = torch.zeros(3, self.range, D, dtype=dtype, device=device)
         self.kernel = None
+        # Varies the stochastic rounding of bfloat16 storage between updates
+        self.seed = 0
         print(N, "CMS", self.cms.size())
 
     def __getstate__(self):
@@ -101,32 +246,60 @@ class CountMinSketch:
         state_dict['blk_size'] = self.blk_size
         state_dict['range'] = self.range
         state_dict['width'] = self.width
-        state_dict['cms'] = self.cms.detach().cpu().numpy()
+        state_dict['dtype'] = self.dtype
+        # numpy has no bfloat16, so store the raw 16-bit pattern instead
+        cms = self.cms.detach()
+        if self.dtype == torch.bfloat16:
+            cms = cms.view(torch.int16)
+        state_dict['cms'] = cms.cpu().numpy()
         return state_dict
 
     def __setstate__(self, d):
         self.__dict__ = d
+        if self.range & (self.range - 1) != 0:
+            raise ValueError("Sketch range {} is not a power of two; it was saved before "
+                             "the kernels hashed with a bitmask".format(self.range))
+        self.__dict__.setdefault('dtype', torch.float32)
         device = torch.cuda.current_device()
         self.cms = torch.from_numpy(self.cms).to(device)
+        if self.dtype == torch.bfloat16:
+            self.cms = self.cms.view(torch.bfloat16)
         self.kernel = None
+        self.seed = 0
 
     def initialize(self):
         if self.kernel is None:
-            self.kernel = cupyKernel(kernel, "hash_update_retrieve")
+            self.blk_size = int(math.ceil(self.D / 32.)) * 32
+            self.kernel = cupyKernel(storage[self.dtype] + kernel, "hash_update_retrieve")
+            self.vec_kernel = None
+            if self.D % 4 == 0:
+                # Each thread handles 4 consecutive lanes with float4 loads
+                self.vec_blk_size = int(math.ceil(self.D / 128.)) * 32
+                self.vec_kernel = cupyKernel(storage[self.dtype] + kernel, "hash_update_retrieve_vec4")
 
     def update(self, indices, values, size):
         self.initialize()
 
+        # The kernels index rows as blockIdx.x * D
+        values = values.contiguous()
         M, D = values.size()
-        result = torch.cuda.FloatTensor(values.size()).fill_(0)
-        self.kernel(grid=(M,1,1),
-                block=(self.blk_size,1,1),
+        # Every element is written by the kernel
+        result = torch.empty_like(values)
+        # float4 loads need 16-byte aligned rows; a sliced or offset view may not be
+        if self.vec_kernel is not None and values.data_ptr() % 16 == 0:
+            func, blk_size = self.vec_kernel, self.vec_blk_size
+        else:
+            func, blk_size = self.kernel, self.blk_size
+        func(grid=(M,1,1),
+                block=(blk_size,1,1),
                 args=[indices.data_ptr(),
                      values.data_ptr(),
                      self.cms.data_ptr(),
                      result.data_ptr(),
-                     self.range,
+                     self.range - 1,
                      self.width,
-                     self.D],
+                     self.D,
+                     self.seed],
                 strm=torch.cuda.current_stream().cuda_stream)
+        self.seed = (self.seed + 1) & 0x7fffffff
         return torch.cuda.sparse.FloatTensor(indices, result, size)
@@ -2,11 +2,25 @@ import cupy as cp
 from cupy.cuda import function
 from cupy.cuda import device
 from pynvrtc.compiler import Program
+from pynvrtc.interface import NVRTCInterface
 from collections import namedtuple
+import hashlib
+import os
 
 # CUDA Stream
 Stream = namedtuple('Stream', ['ptr'])
 
+# Compiled PTX, keyed by kernel source, compile options and NVRTC version.
+# COUNT_SKETCH_KERNEL_CACHE overrides the directory; set it empty to disable the cache
+cache_dir = os.environ.get('COUNT_SKETCH_KERNEL_CACHE',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                                        os.path.join(os.path.expanduser('~'), '.cache'),
+                                        'count_sketch_kernels'))
+nvrtc_version = NVRTCInterface().nvrtcVersion()
+
+# Modules loaded by this process, shared by every kernel instance on a device
+modules = dict()
+
 class cupyKernel:
     def __init__(self, kernel, func_name):
         self.kernel = kernel
@@ -17,20 +31,52 @@ class cupyKernel:
     def get_compute_arch():
         return "compute_{0}".format(device.Device().compute_capability)
 
-    def compile(self):
+    def get_ptx(self, arch):
+        # Compiled PTX depends on the source, the compile options and the NVRTC release
+        options = [arch]
+        key = hashlib.sha1(repr((nvrtc_version, options, self.kernel)).encode()).hexdigest()
+        path = os.path.join(cache_dir, key + ".ptx")
+        if cache_dir:
+            try:
+                with open(path) as f:
+                    return f.read()
+            except OSError:
+                pass
+
         # Create program
         program = Program(self.kernel, self.title)
 
         # Compile program
-        arch = "-arch={0}".format(cupyKernel.get_compute_arch())
-        ptx = program.compile([arch])
+        ptx = program.compile(options)
+        if not cache_dir:
+            return ptx
+
+        # The disk cache is best-effort; write through a temporary file so
+        # concurrent processes never see a partial file
+        tmp_path = "{0}.{1}".format(path, os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                f.write(ptx)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return ptx
 
-        # Load Program
-        m = function.Module()
-        m.load(bytes(ptx.encode()))
+    def compile(self):
+        arch = "-arch={0}".format(cupyKernel.get_compute_arch())
+        key = (device.Device().id, arch, self.kernel)
+        if key not in modules:
+            # Load Program
+            m = function.Module()
+            m.load(bytes(self.get_ptx(arch).encode()))
+            modules[key] = m
 
         # Get Function Pointer
-        self.func = m.get_function(self.func_name)
+        self.func = modules[key].get_function(self.func_name)
         self.compiled = True
 
     def __call__(self, grid, block, args, strm, smem=0):
@@ -3,10 +3,12 @@ from cupy_kernel import cupyKernel
 import numpy as np
 import math
 
+# D, W and the block size are fixed per layer, so they are substituted into the
+# source and compiled as constants - see DenseCMS.initialize
 kernel = '''
 extern "C"
 __inline__ __device__
-int hash(int value, int range, int a, int b)
+int hash(int value, int mask, int a, int b)
 {
 	int h = a * value + b;
 	h ^= h >> 16;
@@ -14,7 +16,7 @@ int hash(int value, int range, int a, int b)
 	h ^= h >> 13;
 	h *= 0xc2b2ae35;
 	h ^= h >> 16;
-	return h % range;
+	return h & mask;
 }
 
 extern "C"
@@ -23,11 +25,11 @@ void dense_cms_update(float* parameter,
 	float* gradient,
 	float* mem,
 	const float* lr_ptr,
-	const float* beta_ptr,
-	const int N,
-	const int D,
-	const int W)
+	const float* beta_ptr)
 {
+	constexpr int D = __D__;
+	constexpr int W = __W__;
+	constexpr int B = __B__;
         const float lr = *lr_ptr;
         const float beta = *beta_ptr;
 	const int offset = blockIdx.x * D;
@@ -39,7 +41,8 @@ void dense_cms_update(float* parameter,
 	float* aux = (float*) &shared[0];
 	float* acc = (float*) &shared[W];
 
-	for(int index = threadIdx.x; index < W; index += blockDim.x)
+	#pragma unroll 4
+	for(int index = threadIdx.x; index < W; index += B)
 	{
 		const int global_index = blockIdx.x * W + index;
 		aux[index] = mem[global_index];
@@ -47,32 +50,34 @@ void dense_cms_update(float* parameter,
 	}
 	__syncthreads();
 
-	for(int index = threadIdx.x; index < D; index += blockDim.x)
+	#pragma unroll 4
+	for(int index = threadIdx.x; index < D; index += B)
 	{
 		// Read chunk from parameters, gradient
 		float p = parameter[offset + index];
 		float g = gradient[offset + index];
-		float value = powf(g, 2);
+		float value = g * g;
 
 		// Calculate auxiliary variable approximation
-		const int hash_idx = hash(offset + index, W, a, b);
-		float v = beta * aux[hash_idx] + (1. - beta) * value;
+		const int hash_idx = hash(offset + index, W - 1, a, b);
+		float v = fmaf(beta, aux[hash_idx], (1.0f - beta) * value);
 
-		// Perform parameter update
-		float update = lr * g * rsqrtf(v + 1e-10);
-		atomicAdd(&parameter[offset + index], update);
+		// Perform parameter update - each element is owned by a single thread
+		float update = lr * g * rsqrtf(v + 1e-10f);
+		parameter[offset + index] = p + update;
 
-		// Update Accumulate Register
-		acc[hash_idx] += value;
-		__syncthreads();
+		// Update Accumulate Register - threads may hash to the same slot
+		atomicAdd(&acc[hash_idx], value);
 	}
+	__syncthreads();
 
-	// Update Auxiliary variables
-	for(int index = threadIdx.x; index < W; index += blockDim.x)
+	// Update Auxiliary variables - each block owns its row of mem
+	#pragma unroll 4
+	for(int index = threadIdx.x; index < W; index += B)
 	{
-		const float global_update = (1. - beta) * (acc[index] - aux[index]);
+		const float global_update = (1.0f - beta) * (acc[index] - aux[index]);
 		const int global_index = blockIdx.x * W + index;
-		atomicAdd(&mem[global_index], global_update);
+		mem[global_index] = aux[index] + global_update;
 	}
 }
 
@@ -82,11 +87,10 @@ void dense_update(float* parameter,
         float* gradient,
         float* mem,
         const float* lr_ptr,
-        const float* beta_ptr,
-        const int N,
-        const int D,
-        const int W)
+        const float* beta_ptr)
 {
+        constexpr int D = __D__;
+        constexpr int B = __B__;
         const float lr = *lr_ptr;
         const float beta = *beta_ptr;
         const int offset = blockIdx.x * D;
@@ -96,7 +100,8 @@ void dense_update(float* parameter,
         float* aux = (float*) &shared[0];
         float* acc = (float*) &shared[D];
 
-        for(int index = threadIdx.x; index < D; index += blockDim.x)
+        #pragma unroll 4
+        for(int index = threadIdx.x; index < D; index += B)
         {
                 const int global_index = blockIdx.x * D + index;
                 aux[index] = mem[global_index];
@@ -104,41 +109,48 @@ void dense_update(float* parameter,
         }
         __syncthreads();
 
-        for(int index = threadIdx.x; index < D; index += blockDim.x)
+        #pragma unroll 4
+        for(int index = threadIdx.x; index < D; index += B)
         {
                 // Read chunk from parameters, gradient
                 float p = parameter[offset + index];
                 float g = gradient[offset + index];
-                float value = powf(g, 2);
+                float value = g * g;
 
                 // Calculate auxiliary variable approximation
-                float v = beta * aux[index] + (1. - beta) * value;
+                float v = fmaf(beta, aux[index], (1.0f - beta) * value);
 
-                // Perform parameter update
-                float update = lr * g * rsqrtf(v + 1e-10);
-                atomicAdd(&parameter[offset + index], update);
+                // Perform parameter update - each element is owned by a single thread
+                float update = lr * g * rsqrtf(v + 1e-10f);
+                parameter[offset + index] = p + update;
 
                 // Update Accumulate Register
                 acc[index] += value;
-                __syncthreads();
         }
+        __syncthreads();
 
-        // Update Auxiliary variables
-        for(int index = threadIdx.x; index < D; index += blockDim.x)
+        // Update Auxiliary variables - each block owns its row of mem
+        #pragma unroll 4
+        for(int index = threadIdx.x; index < D; index += B)
         {
-                const float global_update = (1. - beta) * (acc[index] - aux[index]);
+                const float global_update = (1.0f - beta) * (acc[index] - aux[index]);
                 const int global_index = blockIdx.x * D + index;
-                atomicAdd(&mem[global_index], global_update);
+                mem[global_index] = aux[index] + global_update;
         }
 }
 '''
 
 class DenseCMS:
+    # Kernels specialized for each (device, function, D, W, block size)
+    kernels = dict()
+
     def __init__(self, N, D, sketch_size=0.20):
         self.N = N
         self.D = D
         self.blk_size = 32
-        self.range = max(int(D*sketch_size), 1)
+        # Rounded down to a power of two so the shared-memory sketch never outgrows
+        # sketch_size * D; a range covering all of D uses the exact dense_update kernel
+        self.range = min(1 << (max(int(D*sketch_size), 1).bit_length() - 1), D)
         device = torch.cuda.current_device()
         self.cms = torch.FloatTensor(self.N, self.range).fill_(0).to(device)
         self.kernel = None
@@ -161,16 +173,25 @@ class DenseCMS:
 
     def __setstate__(self, d):
         self.__dict__ = d
+        # range == D selects the exact dense_update kernel, which does not hash
+        if self.range != self.D and self.range & (self.range - 1) != 0:
+            raise ValueError("Sketch range {} is not a power of two; it was saved before "
+                             "the kernels hashed with a bitmask".format(self.range))
         device = torch.cuda.current_device()
         self.cms = torch.from_numpy(self.cms).to(device)
         self.kernel = None
 
     def initialize(self):
         if self.kernel is None:
-            if self.D == self.range:
-                self.kernel = cupyKernel(kernel, "dense_update")
-            else:
-                self.kernel = cupyKernel(kernel, "dense_cms_update")
+            func_name = "dense_update" if self.D == self.range else "dense_cms_update"
+            # A compiled kernel is bound to the device it was first launched on
+            key = (torch.cuda.current_device(), func_name, self.D, self.range, self.blk_size)
+            if key not in DenseCMS.kernels:
+                source = kernel.replace('__D__', str(self.D)) \
+                               .replace('__W__', str(self.range)) \
+                               .replace('__B__', str(self.blk_size))
+                DenseCMS.kernels[key] = cupyKernel(source, func_name)
+            self.kernel = DenseCMS.kernels[key]
 
     def update(self, p, g, lr, beta):
         self.initialize()
@@ -184,10 +205,7 @@ class DenseCMS:
                      g.data_ptr(),
                      self.cms.data_ptr(),
                      lr.data_ptr(),
-                     beta.data_ptr(),
-                     self.N,
-                     self.D,
-                     self.range],
+                     beta.data_ptr()],
                 strm=torch.cuda.current_stream().cuda_stream,
                 smem=int(8*self.range))
 
@@ -6,7 +6,7 @@ import math
 kernel = '''
 extern "C"
 __inline__ __device__
-int hash(int value, int range, int a, int b)
+int hash(int value, int mask, int a, int b)
 {
 	int h = a * value + b;
 	h ^= h >> 16;
@@ -14,9 +14,13 @@ int hash(int value, int range, int a, int b)
 	h ^= h >> 13;
 	h *= 0xc2b2ae35;
 	h ^= h >> 16;
-	return h % range;
+	return h & mask;
 }
 
+// Hash coefficients for the three sketch rows
+__constant__ int hash_a[3] = {994443, 4113759, 9171025};
+__constant__ int hash_b[3] = {609478, 2949676, 2171464};
+
 extern "C"
 __inline__ __device__
 float minimum(float a, float b, float c)
@@ -29,14 +33,14 @@ __inline__ __device__
 float update_retrieve(float* mem,
 	float* result,
 	const float beta,
-	const int N,
+	const int mask,
 	const int D,
 	const long index,
 	const float value)
 {
 	int a = 994443;
 	int b = 609478;
-	const int hash_idx = hash(index, N, a, b) * D + threadIdx.x;
+	const int hash_idx = hash(index, mask, a, b) * D + threadIdx.x;
 	float old_value = mem[hash_idx];
 	float update = (1. - beta) * (value - old_value);
 	atomicAdd(&mem[hash_idx], update);
@@ -48,34 +52,80 @@ __inline__ __device__
 float cms_update_retrieve(float* mem,
 	float* result,
 	const float beta,
-	const int N,
+	const int mask,
 	const int W,
 	const int D,
 	const long index,
 	const float value)
 {
 	float r[3];
-	int a[3] = {994443, 4113759, 9171025};
-	int b[3] = {609478, 2949676, 2171464};
+	int hash_idx[3];
+	float old_value[3];
+	// The rows never alias, so issue all three loads before any atomic
+	for(int idx = 0; idx < 3; ++idx)
+	{
+		hash_idx[idx] = idx*W + hash(index, mask, hash_a[idx], hash_b[idx]) * D + threadIdx.x;
+		old_value[idx] = mem[hash_idx[idx]];
+	}
 	for(int idx = 0; idx < 3; ++idx)
 	{
-		const int hash_idx = idx*W + hash(index, N, a[idx], b[idx]) * D + threadIdx.x;
-		float old_value = mem[hash_idx];
-		float update = (1. - beta) * (value - old_value);
-		atomicAdd(&mem[hash_idx], update);
-		r[idx] = old_value + update;
+		float update = (1. - beta) * (value - old_value[idx]);
+		atomicAdd(&mem[hash_idx[idx]], update);
+		r[idx] = old_value[idx] + update;
 	}
 	return minimum(r[0], r[1], r[2]);
 }
 
+extern "C"
+__inline__ __device__
+float4 cms_update_retrieve4(float* mem,
+	const float beta,
+	const int mask,
+	const int W,
+	const int D,
+	const long index,
+	const float4 value)
+{
+	float4 r[3];
+	float* slot[3];
+	float4 old_value[3];
+	// The rows never alias, so issue all three loads before any atomic
+	for(int idx = 0; idx < 3; ++idx)
+	{
+		// The hash only depends on the index, so 4 consecutive lanes share one slot
+		const int hash_idx = idx*W + hash(index, mask, hash_a[idx], hash_b[idx]) * D + 4 * threadIdx.x;
+		slot[idx] = &mem[hash_idx];
+		old_value[idx] = *reinterpret_cast<const float4*>(slot[idx]);
+	}
+	for(int idx = 0; idx < 3; ++idx)
+	{
+		const float4 update = make_float4((1. - beta) * (value.x - old_value[idx].x),
+			(1. - beta) * (value.y - old_value[idx].y),
+			(1. - beta) * (value.z - old_value[idx].z),
+			(1. - beta) * (value.w - old_value[idx].w));
+		atomicAdd(&slot[idx][0], update.x);
+		atomicAdd(&slot[idx][1], update.y);
+		atomicAdd(&slot[idx][2], update.z);
+		atomicAdd(&slot[idx][3], update.w);
+		r[idx] = make_float4(old_value[idx].x + update.x,
+			old_value[idx].y + update.y,
+			old_value[idx].z + update.z,
+			old_value[idx].w + update.w);
+	}
+	return make_float4(minimum(r[0].x, r[1].x, r[2].x),
+		minimum(r[0].y, r[1].y, r[2].y),
+		minimum(r[0].z, r[1].z, r[2].z),
+		minimum(r[0].w, r[1].w, r[2].w));
+}
+
 extern "C"
 __global__
 void cms_hash_update_retrieve(const long* indices,
 	const float* values,
-	const float* beta,
+	const float beta,
 	float* mem,
 	float* result,
-	const int N,
+	const int mask,
 	const int W,
 	const int D)
 {
@@ -84,7 +134,73 @@ void cms_hash_update_retrieve(const long* indices,
 		const int idx = blockIdx.x * D + threadIdx.x;
 		const float value = values[idx];
 		const long index = indices[blockIdx.x];
-		result[idx] = cms_update_retrieve(mem, result, *beta, N, W, D, index, value);
+		result[idx] = cms_update_retrieve(mem, result, beta, mask, W, D, index, value);
+	}
+}
+
+extern "C"
+__global__
+void cms_hash_update_retrieve_vec4(const long* indices,
+	const float4* values,
+	const float beta,
+	float* mem,
+	float4* result,
+	const int mask,
+	const int W,
+	const int D)
+{
+	const int D4 = D / 4;
+	if(threadIdx.x < D4)
+	{
+		const int idx = blockIdx.x * D4 + threadIdx.x;
+		const float4 value = values[idx];
+		const long index = indices[blockIdx.x];
+		result[idx] = cms_update_retrieve4(mem, beta, mask, W, D, index, value);
+	}
+}
+
+extern "C"
+__global__
+void cms_hash_update_retrieve_sq(const long* indices,
+	const float* values,
+	const float beta,
+	float* mem,
+	float* result,
+	const int mask,
+	const int W,
+	const int D)
+{
+	if(threadIdx.x < D)
+	{
+		const int idx = blockIdx.x * D + threadIdx.x;
+		const float value = values[idx];
+		const long index = indices[blockIdx.x];
+		result[idx] = cms_update_retrieve(mem, result, beta, mask, W, D, index, value * value);
+	}
+}
+
+extern "C"
+__global__
+void cms_hash_update_retrieve_vec4_sq(const long* indices,
+	const float4* values,
+	const float beta,
+	float* mem,
+	float4* result,
+	const int mask,
+	const int W,
+	const int D)
+{
+	const int D4 = D / 4;
+	if(threadIdx.x < D4)
+	{
+		const int idx = blockIdx.x * D4 + threadIdx.x;
+		const float4 value = values[idx];
+		const long index = indices[blockIdx.x];
+		const float4 sq_value = make_float4(value.x * value.x,
+			value.y * value.y,
+			value.z * value.z,
+			value.w * value.w);
+		result[idx] = cms_update_retrieve4(mem, beta, mask, W, D, index, sq_value);
 	}
 }
 '''
@@ -93,12 +209,16 @@ class CountMinSketch:
     def __init__(self, N, D, sketch_size=0.20):
         self.N = N
         self.D = D
-        self.blk_size = math.ceil(D // 32) * 32
-        self.range = int(N*sketch_size/3.)
+        self.blk_size = int(math.ceil(D / 32.)) * 32
+        # Power-of-two range so the kernel hash can use a bitmask instead of modulo,
+        # rounded down to stay within the sketch_size memory budget
+        self.range = 1 << (max(int(N*sketch_size/3.), 1).bit_length() - 1)
         self.width = self.range * D
         device = torch.cuda.current_device()
+        # Row-major (3, range, D): rows hash independently, so interleaving buys no locality
         self.cms = torch.FloatTensor(3, self.range, D).fill_(0).to(device)
         self.kernel = None
+        self.sq_kernel = None
         print(N, "CMS", self.cms.size())
 
     def __getstate__(self):
@@ -113,28 +233,51 @@ class CountMinSketch:
 
     def __setstate__(self, d):
         self.__dict__ = d
+        if self.range & (self.range - 1) != 0:
+            raise ValueError("Sketch range {} is not a power of two; it was saved before "
+                             "the kernels hashed with a bitmask".format(self.range))
         device = torch.cuda.current_device()
         self.cms = torch.from_numpy(self.cms).to(device)
         self.kernel = None
+        self.sq_kernel = None
 
     def initialize(self):
         if self.kernel is None:
+            self.blk_size = int(math.ceil(self.D / 32.)) * 32
             self.kernel = cupyKernel(kernel, "cms_hash_update_retrieve")
+            # Squares the values inside the kernel
+            self.sq_kernel = cupyKernel(kernel, "cms_hash_update_retrieve_sq")
+            self.vec_kernel = None
+            self.vec_sq_kernel = None
+            if self.D % 4 == 0:
+                # Each thread handles 4 consecutive lanes with float4 loads
+                self.vec_blk_size = int(math.ceil(self.D / 128.)) * 32
+                self.vec_kernel = cupyKernel(kernel, "cms_hash_update_retrieve_vec4")
+                self.vec_sq_kernel = cupyKernel(kernel, "cms_hash_update_retrieve_vec4_sq")
 
-    def update(self, indices, values, size, beta):
+    def update(self, indices, values, size, beta, square=False):
         self.initialize()
 
+        # The kernels index rows as blockIdx.x * D
+        values = values.contiguous()
         M, D = values.size()
-        result = torch.cuda.FloatTensor(values.size()).fill_(0)
-        beta = torch.cuda.FloatTensor(1).fill_(beta)
-        self.kernel(grid=(M,1,1),
-                block=(self.blk_size,1,1),
+        # Every element is written by the kernel
+        result = torch.empty_like(values)
+        # float4 loads need 16-byte aligned rows; a sliced or offset view may not be
+        if self.vec_kernel is not None and values.data_ptr() % 16 == 0:
+            func = self.vec_sq_kernel if square else self.vec_kernel
+            blk_size = self.vec_blk_size
+        else:
+            func = self.sq_kernel if square else self.kernel
+            blk_size = self.blk_size
+        func(grid=(M,1,1),
+                block=(blk_size,1,1),
                 args=[indices.data_ptr(),
                      values.data_ptr(),
-                     beta.data_ptr(),
+                     np.float32(beta),
                      self.cms.data_ptr(),
                      result.data_ptr(),
-                     self.range,
+                     self.range - 1,
                      self.width,
                      self.D],
                 strm=torch.cuda.current_stream().cuda_stream)
@@ -7,6 +7,7 @@ from torch.optim import Optimizer
 
 from dense_exp_cms import DenseCMS
 from exp_cms_flat import CountMinSketch
+from sparse_update import sparse_normalized_update
 
 class RMSprop(Optimizer):
     def __init__(self, params, lr=1e-3, beta=0.999, eps=1e-8,
@@ -72,12 +73,6 @@ class RMSprop(Optimizer):
         grad_values = grad._values()
         size = grad.size()
 
-        def make_sparse(values):
-            constructor = grad.new
-            if grad_indices.dim() == 0 or values.dim() == 0:
-                return constructor().resize_as_(grad)
-            return constructor(grad_indices, values, size)
-
         if state['step'] % 1000 == 0:
            #print("Cleaning")
            exp_avg_sq.clean(0.25)
@@ -85,12 +80,10 @@ class RMSprop(Optimizer):
         # Decay the first and second moment running average coefficient
         #      old <- b * old + (1 - b) * new  <==> old += (1 - b) * (new - old)
         exp_avg_sq_update = exp_avg_sq.update(grad_indices, grad_values.pow(2), size, beta)._values()
-        denom = exp_avg_sq_update.sqrt_().add_(group['eps'])
-        update = grad.values() / denom
 
         bias_correction = 1 - beta ** state['step']
         step_size = group['lr'] * math.sqrt(bias_correction)
-        p.data.add_(make_sparse(-step_size * update))
+        sparse_normalized_update(p.data, grad_indices, grad_values, exp_avg_sq_update, step_size, group['eps'])
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -0,0 +1,21 @@
+from typing import Tuple
+
+import torch
+from torch import Tensor
+
+@torch.jit.script
+def _sparse_adam_moments(grad_values, old_exp_avg, old_exp_avg_sq,
+                         beta1: float, beta2: float) -> Tuple[Tensor, Tensor]:
+    # Exact (non-sketched) moving averages of the gradient and its square
+    #      old <- b * old + (1 - b) * new  <==> old += (1 - b) * (new - old)
+    exp_avg = old_exp_avg + (1 - beta1) * (grad_values - old_exp_avg)
+    exp_avg_sq = old_exp_avg_sq + (1 - beta2) * (grad_values * grad_values - old_exp_avg_sq)
+    return exp_avg, exp_avg_sq
+
+@torch.jit.script
+def _sparse_adam_update(grad_values, old_exp_avg, old_exp_avg_sq,
+                        beta1: float, beta2: float, eps: float, step_size: float) -> Tuple[Tensor, Tensor, Tensor]:
+    # Exact (non-sketched) sparse Adam update, fused into a single kernel
+    exp_avg, exp_avg_sq = _sparse_adam_moments(grad_values, old_exp_avg, old_exp_avg_sq, beta1, beta2)
+    update = -step_size * exp_avg / (exp_avg_sq.sqrt() + eps)
+    return exp_avg, exp_avg_sq, update
@@ -0,0 +1,51 @@
+import torch
+from cupy_kernel import cupyKernel
+import numpy as np
+import math
+
+kernel = '''
+extern "C"
+__global__
+void sparse_normalized_update(const long* indices,
+	const float* numer,
+	const float* exp_avg_sq,
+	float* parameter,
+	const float step_size,
+	const float eps,
+	const int D)
+{
+	const int offset = blockIdx.x * D;
+	const long row = indices[blockIdx.x] * D;
+	for(int index = threadIdx.x; index < D; index += blockDim.x)
+	{
+		const float denom = sqrtf(exp_avg_sq[offset + index]) + eps;
+		atomicAdd(&parameter[row + index], -step_size * numer[offset + index] / denom);
+	}
+}
+'''
+
+# A compiled kernel is bound to the device it was first launched on, so keep one per device
+sparse_normalized_kernels = dict()
+
+def sparse_normalized_update(p, indices, numer, exp_avg_sq, step_size, eps):
+    """Fused p[indices] -= step_size * numer / (sqrt(exp_avg_sq) + eps)
+
+    Replaces the sqrt, add, div, mul, sparse tensor construction and
+    sparse-dense add of the Adam and RMSprop sparse updates with a single
+    kernel launch.
+    """
+    M, D = numer.size()
+    blk_size = min(int(math.ceil(D / 32.)) * 32, 1024)
+    device = torch.cuda.current_device()
+    if device not in sparse_normalized_kernels:
+        sparse_normalized_kernels[device] = cupyKernel(kernel, "sparse_normalized_update")
+    sparse_normalized_kernels[device](grid=(M,1,1),
+            block=(blk_size,1,1),
+            args=[indices.data_ptr(),
+                 numer.data_ptr(),
+                 exp_avg_sq.data_ptr(),
+                 p.data_ptr(),
+                 np.float32(step_size),
+                 np.float32(eps),
+                 D],
+            strm=torch.cuda.current_stream().cuda_stream)